@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""Benchmark status polling latency with and without compressed transfer.
+
+Starts a local stub Opsview server that serves a generated api/status/service
+document as gzip, deflate or identity, writing it out no faster than the given
+bandwidth, and times OpsviewRemote.get_status_all() against it.
+
+"""
+
+import gzip
+import optparse
+import random
+import threading
+import time
+import zlib
+from StringIO import StringIO
+import BaseHTTPServer
+import SocketServer
+
+import opsview
+
+_service_outputs = [
+    'HTTP OK: HTTP/1.1 200 OK - %(size)d bytes in %(time).3f second response time',
+    'DISK OK - free space: / %(free)d MB (%(percent)d%% inode=%(inode)d%%):',
+    'OK - load average: %(load1).2f, %(load5).2f, %(load15).2f',
+    'SWAP OK - %(percent)d%% free (%(free)d MB out of %(total)d MB)',
+    'Uptime %(days)d days, %(hours)d hours, %(minutes)d minutes',
+    'TCP OK - %(time).3f second response time on %(ip)s port %(port)d',
+]
+
+def _status_xml(hosts, services, seed=0):
+    """Generate status XML with varied names and plugin output.
+
+    Repeating the same text over and over compresses far better than a real
+    estate's status does, which would overstate the benefit of compression.
+
+    """
+
+    rand = random.Random(seed)
+    def values():
+        return dict({
+            'size':     rand.randint(200, 200000),
+            'time':     rand.random() * 2,
+            'free':     rand.randint(100, 500000),
+            'total':    rand.randint(500000, 1000000),
+            'percent':  rand.randint(0, 100),
+            'inode':    rand.randint(0, 100),
+            'load1':    rand.random() * 8,
+            'load5':    rand.random() * 8,
+            'load15':   rand.random() * 8,
+            'days':     rand.randint(0, 900),
+            'hours':    rand.randint(0, 23),
+            'minutes':  rand.randint(0, 59),
+            'ip':       '10.%d.%d.%d' % (rand.randint(0, 255),
+                rand.randint(0, 255), rand.randint(1, 254)),
+            'port':     rand.randint(1, 65535),
+        })
+    return '<opsview><data>%s</data></opsview>' % ''.join([
+        '<list name="%s-%05d.%s" state="up" current_check_attempt="1" '
+        'max_check_attempts="3" output="PING OK - Packet loss = %d%%, '
+        'RTA = %.2f ms">%s</list>' % (
+            rand.choice(['web', 'db', 'mail', 'cache', 'lb', 'app']),
+            rand.randint(0, 99999),
+            rand.choice(['eu-west', 'us-east', 'ap-south']),
+            rand.randint(0, 5), rand.random() * 200,
+            ''.join([
+                '<services name="%s-%d" state="ok" current_check_attempt="%d" '
+                'max_check_attempts="3" output="%s"/>' % (
+                    rand.choice(['http', 'disk', 'load', 'swap', 'uptime', 'tcp']),
+                    service, rand.randint(1, 3),
+                    rand.choice(_service_outputs) % values())
+                for service in range(services)]))
+        for host in range(hosts)])
+
+def _gzip(data):
+    buf = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+    gzip_file.write(data)
+    gzip_file.close()
+    return buf.getvalue()
+
+class _GzipRemote(opsview.OpsviewRemote):
+    content_encodings = ['gzip']
+
+class _DeflateRemote(opsview.OpsviewRemote):
+    content_encodings = ['deflate']
+
+remote_types = dict({
+    'gzip':     _GzipRemote,
+    'deflate':  _DeflateRemote,
+    'identity': opsview.OpsviewRemote,
+})
+
+class _StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, body):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _StubHandler)
+        self.bodies = dict({
+            'gzip':     _gzip(body),
+            'deflate':  zlib.compress(body, 9),
+            'identity': body,
+        })
+        self.bandwidth = None
+
+class _StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    write_size = 4096
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'auth_tkt=bench; path=/')
+        self.end_headers()
+
+    def do_GET(self):
+        accepted = [encoding.strip() for encoding in
+            self.headers.get('Accept-Encoding', '').split(',')]
+        encoding = 'identity'
+        for candidate in ['gzip', 'deflate']:
+            if candidate in accepted:
+                encoding = candidate
+                break
+        body = self.server.bodies[encoding]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # Pace by total bytes sent, waiting until each chunk would have fully
+        #  crossed the link before writing it, so the last chunk (and a body
+        #  that fits in a single chunk) is throttled too.
+        start = time.time()
+        for offset in range(0, len(body), self.write_size):
+            chunk = body[offset:offset + self.write_size]
+            if self.server.bandwidth:
+                delay = start + float(offset + len(chunk)) / \
+                    self.server.bandwidth - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.wfile.write(chunk)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--hosts', type='int', default=2000)
+    parser.add_option('--services', type='int', default=10)
+    parser.add_option('--bandwidth', action='append', type='float',
+        help='Bandwidth limit in KB/s, may be given more than once '
+            '(default: 1024, 10240 and unlimited)')
+    parser.add_option('--repeat', type='int', default=3)
+    options, args = parser.parse_args()
+    bandwidths = options.bandwidth or [1024, 10240, 0]
+
+    server = _StubServer(_status_xml(options.hosts, options.services))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    base_url = 'http://127.0.0.1:%d/' % server.server_port
+
+    print 'body sizes: %s' % ', '.join(['%s=%dKB' % (name, len(body) / 1024)
+        for name, body in sorted(server.bodies.items())])
+    print '%-12s %-10s %10s %8s' % ('bandwidth', 'encoding', 'latency', 'ratio')
+    for bandwidth in bandwidths:
+        server.bandwidth = bandwidth * 1024
+        for encoding in ['gzip', 'deflate', 'identity']:
+            remote = remote_types[encoding](base_url, 'bench', 'bench',
+                compress=encoding != 'identity')
+            timings = []
+            for i in range(options.repeat):
+                start = time.time()
+                remote.get_status_all()
+                timings.append(time.time() - start)
+            print '%-12s %-10s %9.3fs %7.1f:1' % (
+                (bandwidth and '%dKB/s' % bandwidth) or 'unlimited',
+                encoding, min(timings),
+                float(len(server.bodies['identity'])) /
+                    len(server.bodies[encoding]))
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
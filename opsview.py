@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
+import sys
 from urllib import urlencode, quote_plus
 import urllib2
 import xml.dom.minidom as minidom
 from xml.parsers.expat import ExpatError
+import zlib
+import threading
+import time
 try:
     import json
 except ImportError:
@@ -83,9 +87,142 @@ class OpsviewValueException(OpsviewException):
     def __str__(self):
         return 'Invalid value: "%s" as %s' % (self.value, self.value_name)
 
+class _DecompressingReader(object):
+    """File-like wrapper that decompresses a gzip/deflate HTTP response.
+
+    The response is read and decompressed a chunk at a time as the consumer
+    calls read(), so the full body (compressed or not) is never held in memory
+    at once. This lets minidom.parse() stream straight off the socket. Output
+    is inflated no further than the caller asked for, with the leftover input
+    kept in the decoder's unconsumed_tail, so a small compressed chunk can't
+    blow up into an arbitrarily large buffer.
+
+    """
+
+    chunk_size = 16 * 1024
+    # Fed to the decoder once the response runs out; if the compressed stream
+    #  was complete it ends up in unused_data, otherwise the body was cut off.
+    _end_sentinel = '\x00'
+
+    def __init__(self, response, encoding):
+        self._response = response
+        self._encoding = encoding
+        if encoding == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decoder = zlib.decompressobj(zlib.MAX_WBITS)
+        self._started = False
+        self._complete = False
+        self._tail = ''
+        self._buffer = ''
+        self._eof = False
+
+    # Only the response metadata is passed through, anything that reads from
+    #  the response has to go through the decoder.
+    def info(self):
+        return self._response.info()
+    def geturl(self):
+        return self._response.geturl()
+    def getcode(self):
+        return self._response.getcode()
+    code = property(lambda self: self._response.code)
+    msg = property(lambda self: self._response.msg)
+    headers = property(lambda self: self._response.headers)
+
+    def _decompress(self, chunk, max_length):
+        if self._complete:
+            # Ignore anything the server sent after the end of the stream.
+            self._tail = ''
+            return ''
+        try:
+            data = self._decoder.decompress(chunk, max_length)
+        except zlib.error, error:
+            if self._encoding == 'deflate' and not self._started:
+                # Some servers send raw deflate data without the zlib header.
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                try:
+                    data = self._decoder.decompress(chunk, max_length)
+                except zlib.error, error:
+                    raise OpsviewHTTPException(
+                        'Invalid %s response body: %s' % (self._encoding, error))
+            else:
+                raise OpsviewHTTPException(
+                    'Invalid %s response body: %s' % (self._encoding, error))
+        self._started = True
+        self._tail = self._decoder.unconsumed_tail
+        if self._decoder.unused_data:
+            self._complete = True
+        return data
+
+    def _finish(self):
+        if not self._complete:
+            try:
+                self._buffer += self._decoder.decompress(
+                    self.__class__._end_sentinel)
+                self._complete = \
+                    self._decoder.unused_data == self.__class__._end_sentinel
+            except zlib.error:
+                pass
+        if not self._complete:
+            raise OpsviewHTTPException(
+                'Truncated %s response body' % self._encoding)
+        self._buffer += self._decoder.flush()
+        self._eof = True
+
+    def _fill(self, size):
+        """Decompress until the buffer holds size bytes or the body ends."""
+
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            if self._tail:
+                chunk = self._tail
+            else:
+                chunk = self._response.read(self.__class__.chunk_size)
+                if not chunk:
+                    self._finish()
+                    continue
+            if size < 0:
+                max_length = self.__class__.chunk_size
+            else:
+                max_length = size - len(self._buffer)
+            self._buffer += self._decompress(chunk, max_length)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while '\n' not in self._buffer and not self._eof and \
+            (size < 0 or len(self._buffer) < size):
+            self._fill(len(self._buffer) + self.__class__.chunk_size)
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def readlines(self, sizehint=None):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self._response.close()
+
 #class Remote(object):
 class OpsviewRemote(object):
-    """Remote interface to Opsview server."""
+    """Remote interface to Opsview server.
+
+    Status requests ask for a gzip or deflate compressed reply unless compress
+    is False. timeout is the socket timeout in seconds for every request, None
+    leaves it at the global socket default (and it's ignored before Python 2.6,
+    where urllib2 doesn't support it).
+
+    """
 
     api_urls = dict({
         'acknowledge':          'status/service/acknowledge',
@@ -109,11 +246,15 @@ class OpsviewRemote(object):
         #'json': 'application/json',
         'xml':  'text/xml',
     })
+    content_encodings = ['gzip', 'deflate']
 
-    def __init__(self, base_url, username, password, content_type=None):
+    def __init__(self, base_url, username, password, content_type=None,
+        compress=True, timeout=None):
         self.base_url = base_url
         self.username = username
         self.password = password
+        self.compress = compress
+        self.timeout = timeout
         self._cookies = urllib2.HTTPCookieProcessor()
         self._opener = urllib2.build_opener(self._cookies)
         try:
@@ -124,6 +265,12 @@ class OpsviewRemote(object):
     def __str__(self):
         return '%s(%s)' % (self.__class__.__name__, self.base_url)
 
+    def _open(self, request):
+        if self.timeout is not None and sys.version_info >= (2, 6):
+            # The timeout argument was added to urllib2 in Python 2.6
+            return self._opener.open(request, timeout=self.timeout)
+        return self._opener.open(request)
+
     def login(self):
         """Login to the Opsview server.
 
@@ -136,7 +283,7 @@ class OpsviewRemote(object):
         
         if 'auth_tkt' not in [cookie.name for cookie in self._cookies.cookiejar]:
             try:
-                self._opener.open(
+                self._open(
                     urllib2.Request(self.base_url + self.__class__.api_urls['login'],
                     urlencode(dict({
                         'login':'Log In',
@@ -215,11 +362,17 @@ class OpsviewRemote(object):
                 headers
             )
         request.add_header('Content-Type', self._content_type)
+        if self.compress:
+            request.add_header('Accept-Encoding',
+                ', '.join(self.__class__.content_encodings))
         self.login()
         try:
-            reply = self._opener.open(request)
+            reply = self._open(request)
         except urllib2.HTTPError, error:
             raise OpsviewHTTPException(error)
+        encoding = (reply.info().getheader('Content-Encoding') or '').strip().lower()
+        if encoding in self.__class__.content_encodings:
+            reply = _DecompressingReader(reply, encoding)
         return reply
 
     def _send_post(self, location, data, headers=None):
@@ -231,7 +384,7 @@ class OpsviewRemote(object):
             )
         self.login()
         try:
-            reply = self._opener.open(request)
+            reply = self._open(request)
         except urllib2.HTTPError, error:
             raise OpsviewHTTPException(error)
         return reply
@@ -680,4 +833,217 @@ class OpsviewHostgroup(OpsviewServer):
     def update(self, filters=None):
         self.parse_xml(
             self.remote.get_status_by_hostgroup(self.id, filters))
-        return self
\ No newline at end of file
+        return self
+
+#class Federation(object):
+class OpsviewFederation(object):
+    """Parallel interface to several Opsview servers.
+
+    Takes a dict of name -> OpsviewRemote (or just a list of remotes, which are
+    then named by their base_url) and runs status queries and acknowledgements
+    against all of them at once, one thread per server. A server that errors
+    out or doesn't answer within timeout seconds is reported as an error
+    instead of holding up the rest.
+
+    get_status_all(), acknowledge() and acknowledge_all() return a tuple of
+    (results, errors, latency), each a dict keyed by server name, with latency
+    being the seconds each server took (or was waited on, for timeouts). The
+    most recent errors and latency of each operation are also kept in
+    self.errors and self.latency keyed by method name, e.g.
+    self.latency['update']['server1'].
+
+    A call that times out can't be cancelled, its thread is left to finish (or
+    hit the remote's socket timeout) in the background. Until it does, that
+    server is skipped and reported as still in progress, so a hung server never
+    has more than one request outstanding. Remotes without a socket timeout of
+    their own are given remote_timeout.
+
+    After update(), servers holds an OpsviewServer tree per server name and
+    index maps server name -> host name -> (OpsviewHost, dict of service name ->
+    OpsviewService). The time of each server's last successful update is kept
+    in updated, and the names of servers whose tree is left over from an
+    earlier update are in stale.
+
+    """
+
+    _ack_timeout_message = \
+        'Outcome unknown, no reply after %s seconds (may still be acknowledged)'
+
+    def __init__(self, remotes, timeout=30, remote_timeout=60):
+        if isinstance(remotes, dict):
+            self.remotes = dict(remotes)
+        else:
+            self.remotes = dict([(remote.base_url, remote) for remote in remotes])
+        for remote in self.remotes.values():
+            if remote.timeout is None:
+                remote.timeout = remote_timeout
+        self.timeout = timeout
+        self.servers = dict({})
+        self.index = dict({})
+        self.updated = dict({})
+        self.stale = set()
+        self.errors = dict({})
+        self.latency = dict({})
+        self._running = dict({})
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+            ', '.join(sorted(self.remotes)))
+
+    def _run_parallel(self, operation, targets, timeout=None,
+        timeout_message='Timed out after %s seconds'):
+        """Call targets[name]() for each name in its own thread.
+
+        Returns a tuple of (results, errors, latency) dicts keyed by name,
+        results only holding the calls that finished in time without raising.
+        errors and latency are also saved under operation in self.errors and
+        self.latency.
+
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+        # Kept local so a timed out thread that finishes late can't write into
+        #  the results of a later run.
+        results = dict({})
+        errors = dict({})
+        latency = dict({})
+        lock = threading.Lock()
+
+        def run(name):
+            start = time.time()
+            try:
+                result = targets[name]()
+            except Exception, error:
+                result = error
+                failed = True
+            else:
+                failed = False
+            lock.acquire()
+            try:
+                latency[name] = time.time() - start
+                if failed:
+                    errors[name] = result
+                else:
+                    results[name] = result
+            finally:
+                lock.release()
+
+        start = time.time()
+        threads = dict({})
+        self._lock.acquire()
+        try:
+            for name in targets:
+                if name in self._running and self._running[name][0].isAlive():
+                    errors[name] = OpsviewHTTPException(
+                        'Previous request still in progress')
+                    latency[name] = start - self._running[name][1]
+                    continue
+                threads[name] = threading.Thread(target=run, args=(name,))
+                # A hung server shouldn't keep the interpreter from exiting.
+                threads[name].setDaemon(True)
+                threads[name].start()
+                self._running[name] = (threads[name], start)
+        finally:
+            self._lock.release()
+        if timeout is not None:
+            deadline = start + timeout
+        for name in threads:
+            if timeout is None:
+                threads[name].join()
+            else:
+                threads[name].join(max(0, deadline - time.time()))
+        lock.acquire()
+        try:
+            for name in threads:
+                if name not in results and name not in errors:
+                    errors[name] = OpsviewHTTPException(timeout_message % timeout)
+                    latency[name] = time.time() - start
+            results, errors, latency = dict(results), dict(errors), dict(latency)
+        finally:
+            lock.release()
+        self.errors[operation] = errors
+        self.latency[operation] = latency
+        return results, errors, latency
+
+    def get_status_all(self, filters=None, timeout=None):
+        """Get status of all services on every server.
+
+        The results are a dict of server name -> status XML document, servers
+        that failed are left out and can be found in the errors.
+
+        """
+
+        return self._run_parallel('get_status_all', dict([
+            (name, lambda remote=remote: remote.get_status_all(filters))
+            for name, remote in self.remotes.items()]), timeout)
+
+    def update(self, filters=None, timeout=None):
+        """Refresh the status tree and index of every server.
+
+        Servers that fail keep their previous tree (if any) so one slow or
+        broken server doesn't blank out its part of the global view, they are
+        listed in self.stale until they update successfully again. Errors and
+        latency are in self.errors['update'] and self.latency['update'].
+
+        """
+
+        servers = self._run_parallel('update', dict([
+            (name, lambda remote=remote:
+                OpsviewServer(remote=remote).update(filters))
+            for name, remote in self.remotes.items()]), timeout)[0]
+        now = time.time()
+        for name in servers:
+            self.updated[name] = now
+        self.servers.update(servers)
+        self.stale = set([name for name in self.servers if name not in servers])
+        index = dict({})
+        for name in self.servers:
+            index[name] = dict({})
+            # parse_xml turns numeric attributes into ints, names should
+            #  always be looked up as strings.
+            for host in self.servers[name].children:
+                index[name][unicode(host['name'])] = (host, dict([
+                    (unicode(service['name']), service)
+                    for service in host.children]))
+        self.index = index
+        return self
+
+    def acknowledge(self, targets, comment, notify=True, auto_remove_comment=True,
+        timeout=None):
+        """Send acknowledgements to several servers at once.
+
+        Targets should be a dict of server name -> the targets layout used by
+        OpsviewRemote._acknowledge:
+        targets=dict({
+            server1:dict({host1:[list, of, services], host2:[None]}),
+        })
+
+        A server that doesn't reply in time is reported in the errors with an
+        unknown outcome rather than as a failure, the acknowledgement may still
+        go through so retrying it straight away can acknowledge twice.
+
+        """
+
+        for name in targets:
+            if name not in self.remotes:
+                raise OpsviewValueException('server', name)
+        return self._run_parallel('acknowledge', dict([
+            (name, lambda name=name: self.remotes[name]._acknowledge(
+                targets[name], comment, notify, auto_remove_comment))
+            for name in targets]), timeout, self.__class__._ack_timeout_message)
+
+    def acknowledge_all(self, comment, notify=True, auto_remove_comment=True,
+        timeout=None):
+        """Acknowledge all currently alerting hosts and services on every server.
+
+        Timeouts are reported the same way as for acknowledge().
+
+        """
+
+        return self._run_parallel('acknowledge_all', dict([
+            (name, lambda remote=remote: remote.acknowledge_all(
+                comment, notify, auto_remove_comment))
+            for name, remote in self.remotes.items()]), timeout,
+            self.__class__._ack_timeout_message)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+import gzip
+import sys
+import threading
+import time
+import unittest
+import zlib
+from StringIO import StringIO
+import xml.dom.minidom as minidom
+
+import opsview
+
+STATUS_XML = '<opsview><data>%s</data></opsview>' % ''.join([
+    '<list name="host%d" current_check_attempt="1" max_check_attempts="3">'
+    '<services name="service%d" current_check_attempt="1" max_check_attempts="3"/>'
+    '</list>' % (i, i) for i in range(2000)])
+
+def _gzip(data):
+    buf = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+    gzip_file.write(data)
+    gzip_file.close()
+    return buf.getvalue()
+
+def _raw_deflate(data):
+    # Strip the 2 byte zlib header and 4 byte adler32 trailer.
+    return zlib.compress(data)[2:-4]
+
+class _FakeResponse(StringIO):
+    """Just enough of a urllib2 response to wrap."""
+
+    code = 200
+    msg = 'OK'
+
+    def info(self):
+        return 'info'
+    def geturl(self):
+        return 'http://opsview.example/'
+    def getcode(self):
+        return self.code
+
+class DecompressingReaderTest(unittest.TestCase):
+
+    def reader(self, body, encoding):
+        return opsview._DecompressingReader(_FakeResponse(body), encoding)
+
+    def test_gzip(self):
+        self.assertEqual(self.reader(_gzip(STATUS_XML), 'gzip').read(),
+            STATUS_XML)
+
+    def test_deflate(self):
+        self.assertEqual(
+            self.reader(zlib.compress(STATUS_XML), 'deflate').read(),
+            STATUS_XML)
+
+    def test_raw_deflate(self):
+        self.assertEqual(
+            self.reader(_raw_deflate(STATUS_XML), 'deflate').read(),
+            STATUS_XML)
+
+    def test_small_reads(self):
+        reader = self.reader(_gzip(STATUS_XML), 'gzip')
+        chunks = []
+        for data in iter(lambda: reader.read(100), ''):
+            self.assertTrue(len(data) <= 100)
+            chunks.append(data)
+        self.assertEqual(''.join(chunks), STATUS_XML)
+
+    def test_buffer_bounded(self):
+        # 16MB of zeros compresses down to a few KB, a single small read
+        #  shouldn't inflate all of it.
+        reader = self.reader(zlib.compress('\0' * (16 * 1024 * 1024)), 'deflate')
+        self.assertEqual(len(reader.read(10)), 10)
+        self.assertTrue(len(reader._buffer) + len(reader._tail) <
+            2 * opsview._DecompressingReader.chunk_size)
+
+    def test_readline(self):
+        text = 'first\nsecond\nthird'
+        self.assertEqual(self.reader(_gzip(text), 'gzip').readlines(),
+            ['first\n', 'second\n', 'third'])
+        reader = self.reader(_gzip(text), 'gzip')
+        self.assertEqual(reader.readline(3), 'fir')
+        self.assertEqual(reader.readline(), 'st\n')
+
+    def test_metadata(self):
+        reader = self.reader(_gzip(STATUS_XML), 'gzip')
+        self.assertEqual(reader.info(), 'info')
+        self.assertEqual(reader.geturl(), 'http://opsview.example/')
+        self.assertEqual(reader.getcode(), 200)
+        self.assertEqual(reader.code, 200)
+        self.assertEqual(reader.msg, 'OK')
+        self.assertRaises(AttributeError, getattr, reader, 'fileno')
+
+    def test_minidom_parse(self):
+        document = minidom.parse(self.reader(_gzip(STATUS_XML), 'gzip'))
+        self.assertEqual(len(document.getElementsByTagName('list')), 2000)
+
+    def test_truncated(self):
+        for body, encoding in [
+            (_gzip(STATUS_XML)[:-10], 'gzip'),
+            (_gzip(STATUS_XML)[:len(_gzip(STATUS_XML)) / 2], 'gzip'),
+            (zlib.compress(STATUS_XML)[:-10], 'deflate'),
+            (_raw_deflate(STATUS_XML)[:-10], 'deflate'),
+            ('', 'gzip'),
+        ]:
+            self.assertRaises(opsview.OpsviewHTTPException,
+                self.reader(body, encoding).read)
+
+    def test_corrupt(self):
+        body = _gzip(STATUS_XML)
+        body = body[:100] + 'garbage' * 10 + body[170:]
+        self.assertRaises(opsview.OpsviewHTTPException,
+            self.reader(body, 'gzip').read)
+        self.assertRaises(opsview.OpsviewHTTPException,
+            self.reader('not compressed at all', 'deflate').read)
+
+class _RecordingOpener(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def open(self, request, **kwargs):
+        self.calls.append(kwargs)
+
+class RemoteTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.version_info = sys.version_info
+
+    def tearDown(self):
+        sys.version_info = self.version_info
+
+    def remote(self, **kwargs):
+        remote = opsview.OpsviewRemote('http://stub/', 'user', 'pass', **kwargs)
+        remote._opener = _RecordingOpener()
+        return remote
+
+    def test_default(self):
+        remote = self.remote()
+        remote._open('request')
+        self.assertEqual(remote._opener.calls, [dict({})])
+
+    def test_timeout(self):
+        remote = self.remote(timeout=5)
+        remote._open('request')
+        self.assertEqual(remote._opener.calls, [dict({'timeout': 5})])
+
+    def test_timeout_before_python26(self):
+        sys.version_info = (2, 5, 4, 'final', 0)
+        remote = self.remote(timeout=5)
+        remote._open('request')
+        self.assertEqual(remote._opener.calls, [dict({})])
+
+class _StubRemote(opsview.OpsviewRemote):
+    """Remote that answers from memory, optionally blocking or failing."""
+
+    def __init__(self, status_xml, fail=False):
+        opsview.OpsviewRemote.__init__(self, 'http://stub/', 'user', 'pass')
+        self.status_xml = status_xml
+        self.fail = fail
+        self.release = threading.Event()
+        self.release.set()
+        self.calls = 0
+        self.acknowledged = []
+
+    def _wait(self):
+        self.calls += 1
+        self.release.wait()
+        if self.fail:
+            raise opsview.OpsviewHTTPException('stub failure')
+
+    def get_status_all(self, filters=None):
+        self._wait()
+        return minidom.parseString(self.status_xml)
+
+    def _acknowledge(self, targets, comment='', notify=True, auto_remove_comment=True):
+        self._wait()
+        self.acknowledged.append(targets)
+        return 'ok'
+
+def _host_xml(*hosts):
+    return '<opsview><data>%s</data></opsview>' % ''.join([
+        '<list name="%s" state="%s" current_check_attempt="1" max_check_attempts="3">'
+        '<services name="%s" current_check_attempt="1" max_check_attempts="3"/>'
+        '</list>' % (host, state, service) for host, state, service in hosts])
+
+class FederationTest(unittest.TestCase):
+
+    # Generous so the fast stubs never time out on a loaded machine, the slow
+    #  stub blocks until released so it always does.
+    timeout = 2
+
+    def setUp(self):
+        self.fast = _StubRemote(_host_xml(
+            ('web1', 'up', 'HTTP'), ('123', 'down', '443')))
+        self.slow = _StubRemote(_host_xml(('db1', 'up', 'MySQL')))
+        self.broken = _StubRemote(_host_xml(('mail1', 'up', 'SMTP')))
+        self.federation = opsview.OpsviewFederation(dict({
+            'fast':     self.fast,
+            'slow':     self.slow,
+            'broken':   self.broken,
+        }), timeout=self.timeout)
+
+    def tearDown(self):
+        for remote in self.federation.remotes.values():
+            remote.release.set()
+
+    def test_remote_timeout(self):
+        remote = _StubRemote(_host_xml())
+        remote.timeout = 5
+        federation = opsview.OpsviewFederation(dict({'own': remote}),
+            remote_timeout=10)
+        self.assertEqual(remote.timeout, 5)
+        self.assertEqual(self.fast.timeout, 60)
+        self.assertEqual(_StubRemote(_host_xml()).timeout, None)
+
+    def test_update(self):
+        self.federation.update()
+        self.assertEqual(self.federation.errors['update'], dict({}))
+        self.assertEqual(sorted(self.federation.index), ['broken', 'fast', 'slow'])
+        host, services = self.federation.index['fast']['web1']
+        self.assertEqual(host['state'], 'up')
+        self.assertEqual(services['HTTP']['name'], 'HTTP')
+        self.assertTrue(services['HTTP'].parent is host)
+        # Numeric names are coerced to ints by parse_xml, but not in the index.
+        host, services = self.federation.index['fast'][u'123']
+        self.assertEqual(host['state'], 'down')
+        self.assertTrue(u'443' in services)
+        self.assertEqual(self.federation.stale, set())
+        self.assertEqual(sorted(self.federation.latency['update']),
+            ['broken', 'fast', 'slow'])
+
+    def test_slow_and_broken(self):
+        self.federation.update()
+        first_update = dict(self.federation.updated)
+        old_slow_tree = self.federation.servers['slow']
+        old_broken_tree = self.federation.servers['broken']
+
+        self.slow.release.clear()
+        self.broken.fail = True
+        start = time.time()
+        self.federation.update()
+        elapsed = time.time() - start
+        self.assertTrue(elapsed < self.timeout + 5, elapsed)
+
+        errors = self.federation.errors['update']
+        latency = self.federation.latency['update']
+        self.assertEqual(sorted(errors), ['broken', 'slow'])
+        self.assertTrue('Timed out' in str(errors['slow']))
+        self.assertTrue('stub failure' in str(errors['broken']))
+        self.assertTrue(latency['slow'] >= self.timeout)
+        self.assertTrue(latency['fast'] < latency['slow'])
+
+        # Failed servers keep their old tree, marked as stale.
+        self.assertTrue(self.federation.servers['slow'] is old_slow_tree)
+        self.assertTrue(self.federation.servers['broken'] is old_broken_tree)
+        self.assertTrue('MySQL' in self.federation.index['slow']['db1'][1])
+        self.assertEqual(self.federation.stale, set(['slow', 'broken']))
+        self.assertEqual(self.federation.updated['slow'], first_update['slow'])
+        self.assertTrue(self.federation.updated['fast'] >= first_update['fast'])
+
+    def test_errors_kept_per_operation(self):
+        self.broken.fail = True
+        self.federation.update()
+        self.broken.fail = False
+        results, errors, latency = self.federation.get_status_all()
+        self.assertEqual(sorted(results), ['broken', 'fast', 'slow'])
+        self.assertEqual(errors, dict({}))
+        self.assertEqual(self.federation.errors['get_status_all'], dict({}))
+        self.assertTrue('broken' in self.federation.errors['update'])
+        self.assertTrue('broken' in self.federation.latency['update'])
+
+    def test_no_pileup_on_hung_server(self):
+        self.slow.release.clear()
+        for i in range(4):
+            results, errors, latency = self.federation.get_status_all(timeout=0.1)
+        self.assertEqual(self.slow.calls, 1)
+        self.assertTrue('in progress' in str(errors['slow']))
+        self.slow.release.set()
+        self.federation._running['slow'][0].join()
+        results, errors, latency = self.federation.get_status_all()
+        self.assertTrue('slow' in results)
+        self.assertEqual(self.slow.calls, 2)
+
+    def test_acknowledge(self):
+        self.slow.release.clear()
+        results, errors, latency = self.federation.acknowledge(dict({
+            'fast': dict({'web1': ['HTTP']}),
+            'slow': dict({'db1': [None]}),
+        }), 'on it')
+        self.assertEqual(results, dict({'fast': 'ok'}))
+        self.assertEqual(self.fast.acknowledged, [dict({'web1': ['HTTP']})])
+        self.assertTrue('Outcome unknown' in str(errors['slow']))
+        self.assertTrue(errors['slow'] is
+            self.federation.errors['acknowledge']['slow'])
+
+    def test_acknowledge_unknown_server(self):
+        self.assertRaises(opsview.OpsviewValueException,
+            self.federation.acknowledge, dict({'nowhere': dict({})}), 'on it')
+        self.assertEqual(self.fast.calls, 0)
+
+if __name__ == '__main__':
+    unittest.main()